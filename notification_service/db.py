@@ -1,25 +1,25 @@
-from dataclasses import field
-from enum import Enum
-from typing import Protocol
+import asyncio
+import contextlib
+from typing import Literal, Protocol, TypeAlias, TypedDict, cast
 
+from bson import ObjectId
+from motor.frameworks.asyncio import max_workers as motor_max_workers
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_serializer
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
-
-class NotificationKey(str, Enum):
-    """Type of notification."""
-
-    REGISTRATION = "registration"
-    NEW_MESSAGE = "new_message"
-    NEW_POST = "new_post"
-    NEW_LOGIN = "new_login"
+# Type of notification.
+NotificationKey: TypeAlias = Literal[
+    "registration", "new_message", "new_post", "new_login"
+]
 
 
 class Notification(BaseModel):
     """A pydantic view of user's notification.
 
     Attributes:
-        id: The unique identifier of the notification.
+        id: The unique identifier of the notification. Serialized to JSON as a hex string.
         timestamp: The time when the notification was created.
         is_new: Indicates if the notification is new or not.
         user_id: The ID of the user to whom the notification is sent.
@@ -28,7 +28,9 @@ class Notification(BaseModel):
         data: Additional data associated with the notification, if any.
     """
 
-    id: str
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    id: ObjectId
     timestamp: int
     is_new: bool
     user_id: str
@@ -36,136 +38,317 @@ class Notification(BaseModel):
     target_id: str | None = None
     data: dict | None = None
 
+    @field_serializer("id", when_used="json")
+    def serialize_id(self, id: ObjectId) -> str:
+        return str(id)
 
-class User(BaseModel):
-    """A view of user's notifications.
 
-    Attributes:
-        id: The unique identifier of the user.
-        notifications: a pydantic view of user's notification.
+class NotificationDocument(TypedDict):
+    """A notification document as it is stored in MongoDB.
+
+    The ID of the notification is stored as `_id`, so the built-in `_id` index is used to find it.
     """
 
-    id: str
-    notifications: list[Notification] = field(default_factory=list)
+    _id: ObjectId
+    timestamp: int
+    is_new: bool
+    user_id: str
+    key: NotificationKey
+    target_id: str | None
+    data: dict | None
+
+
+NOTIFICATION_PROJECTION = {name: 1 for name in NotificationDocument.__annotations__}
+
+
+def to_notification(document: NotificationDocument) -> Notification:
+    """Convert the database document to Notification() model without validation."""
+
+    fields = dict(document)
+    return Notification.model_construct(id=fields.pop("_id"), **fields)
 
 
 class Database(Protocol):
     """Database interface."""
 
+    __slots__ = ()
+
     async def get_notification(
-        self, user_id: str, notification_id: str
+        self, user_id: str, notification_id: ObjectId
     ) -> Notification:
         """Retrieve a notification document from the database by user ID and notification ID."""
 
     async def get_notifications(
-        self, user_id: str, skip: int, limit: int
+        self,
+        user_id: str,
+        limit: int,
+        after_ts: int | None = None,
+        after_id: ObjectId | None = None,
     ) -> list[Notification]:
         """Retrieve a list of notification documents from the database by user ID.
-        
+
+        Notifications are ordered from the newest to the oldest one by `timestamp`
+        and `id`. If a cursor is given, only notifications which go after it are returned.
+
         Args:
             user_id: The unique identifier of the user.
-            skip: Number of notifications that can be skipped.
             limit: Number of notifications that can be limited.
+            after_ts: The timestamp of the last notification of the previous page.
+            after_id: The ID of the last notification of the previous page.
         """
 
     async def save_notification(self, notification: Notification):
         """Save the notification to the database."""
 
+    async def mark_read(self, user_id: str, notification_id: ObjectId) -> bool:
+        """Set `is_new = False` for the notification of the user.
+
+        Returns:
+            True if the notification was new, False if it has already been read.
+
+        Raises:
+            NotificationNotFound: the notification is not found.
+        """
+
+
+class NotificationSink:
+    """Writer which groups concurrently saved notifications into batches.
+
+    A batch is collected for `window` seconds after its first notification, up to
+    `batch_size` notifications, and is written with a single `bulk_write`. The
+    notifications of the written users which exceed `notifications_limit` are deleted
+    by a separate task, so trimming does not hold up the next batch.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        notifications_limit: int,
+        batch_size: int = 128,
+        window: float = 0.005,
+    ):
+        self._collection = collection
+        self._notifications_limit = notifications_limit
+        self._batch_size = batch_size
+        self._window = window
+        self._queue = asyncio.Queue[tuple[Notification, asyncio.Future]]()
+        self._task: asyncio.Task | None = None
+        self._untrimmed: set[str] = set()
+        self._trim_task: asyncio.Task | None = None
+
+    async def save(self, notification: Notification):
+        """Queue the notification and wait until its batch is written."""
+
+        # The task is restarted if it has been stopped by an unexpected error.
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((notification, future))
+        await future
+
+    async def close(self):
+        """Stop the writer. Notifications which are not written yet are cancelled."""
+
+        for task in (self._task, self._trim_task):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        self._task = self._trim_task = None
+
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                await asyncio.sleep(self._window)
+                while len(batch) < self._batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                await self._flush(batch)
+            finally:
+                # Does nothing for the resolved futures, so only the waiters of
+                # an interrupted batch are cancelled.
+                for _, future in batch:
+                    future.cancel()
+
+    async def _flush(self, batch: list[tuple[Notification, asyncio.Future]]):
+        """Write the batch, resolve its futures and schedule its users to be trimmed."""
+
+        failed: dict[int, Exception] = {}
+        try:
+            await self._collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"_id": notification.id},
+                        {"$set": notification.model_dump(exclude={"id"})},
+                        upsert=True,
+                    )
+                    for notification, _ in batch
+                ],
+                ordered=False,
+            )
+        except BulkWriteError as e:
+            failed = {error["index"]: e for error in e.details["writeErrors"]}
+        except Exception as e:
+            failed = {index: e for index in range(len(batch))}
+
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(None)
+
+        self._untrimmed.update(notification.user_id for notification, _ in batch)
+        if self._trim_task is None or self._trim_task.done():
+            self._trim_task = asyncio.create_task(self._trim_users())
+
+    async def _trim_users(self):
+        """Trim the users written since the previous pass until there are none left.
+
+        A user written several times during a pass is trimmed once in the next one.
+        Trimming is best-effort: notifications left over are deleted the next time
+        the user is trimmed.
+        """
+
+        while self._untrimmed:
+            user_ids, self._untrimmed = self._untrimmed, set()
+            await asyncio.gather(
+                *(self._trim(user_id) for user_id in user_ids), return_exceptions=True
+            )
+
+    async def _trim(self, user_id: str):
+        """Delete the user's notifications which exceed the notifications limit."""
+
+        stale = (
+            await self._collection.find({"user_id": user_id}, {"_id": 1})
+            .sort([("timestamp", -1), ("_id", -1)])
+            .skip(self._notifications_limit)
+            .to_list(None)
+        )
+        if stale:
+            await self._collection.delete_many(
+                {"_id": {"$in": [note["_id"] for note in stale]}}
+            )
+
 
 class MongoDatabase(Database):
-    """MongoDB database implementation."""
+    """MongoDB database implementation.
+
+    Every notification is stored as a separate document of the `notifications`
+    collection, so the user's notifications are fetched by an index seek on
+    `(user_id, timestamp, _id)` instead of a collection scan. Notifications are
+    written in batches by `NotificationSink`. Read documents are trusted, so they
+    are turned into `Notification` without validation.
+
+    Motor runs every operation on its thread pool, and a thread holds at most one
+    connection at a time, so the concurrency of the queries is limited by the size
+    of the thread pool (`MOTOR_MAX_WORKERS`) and not by the connection pool. By
+    default the connection pool is sized to match the thread pool.
+    """
 
     def __init__(
         self,
         uri: str,
         db_name: str = "db",
-        collection_name: str = "users",
+        collection_name: str = "notifications",
         notifications_limit: int = 3,
+        max_pool_size: int = motor_max_workers,
     ):
-        self.client = AsyncIOMotorClient(uri)
-        self._users: AsyncIOMotorCollection = self.client[db_name][collection_name]
+        self._uri = uri
+        self._db_name = db_name
+        self._collection_name = collection_name
         self._notifications_limit = notifications_limit
+        self._max_pool_size = max_pool_size
+
+    async def connect(self):
+        """Create the client of the database and the indexes the queries rely on.
+
+        The client is created here rather than in `__init__`, so that it is created
+        in the process and the event loop which will use it.
+        """
+
+        self.client = AsyncIOMotorClient(
+            self._uri,
+            maxPoolSize=self._max_pool_size,
+            serverSelectionTimeoutMS=2000,
+            connectTimeoutMS=2000,
+        )
+        self._notifications: AsyncIOMotorCollection = self.client[self._db_name][
+            self._collection_name
+        ]
+        self._sink = NotificationSink(self._notifications, self._notifications_limit)
+
+        await self._notifications.create_index(
+            [("user_id", 1), ("timestamp", -1), ("_id", -1)]
+        )
+
+    async def close(self):
+        """Stop the notification writer and close the client of the database."""
+
+        await self._sink.close()
+        self.client.close()
 
     async def get_notification(
-        self, user_id: str, notification_id: str
+        self, user_id: str, notification_id: ObjectId
     ) -> Notification:
-        result = await self.get_records(user_id)
-        for res in result:
-            if res["notifications"]["$each"][0]["id"] == notification_id:
-                return self.convert_notification(res)
+        result = await self._notifications.find_one(
+            {"_id": notification_id, "user_id": user_id}, NOTIFICATION_PROJECTION
+        )
+        if result is None:
+            raise NotificationNotFound()
 
-        raise NotificationNotFound()
+        return to_notification(cast(NotificationDocument, result))
 
     async def get_notifications(
-        self, user_id: str, skip: int, limit: int
+        self,
+        user_id: str,
+        limit: int,
+        after_ts: int | None = None,
+        after_id: ObjectId | None = None,
     ) -> list[Notification]:
-        notifications_data = await self.get_records(user_id)
-        notifications_count = len(notifications_data)
-
-        if notifications_count == 0 or skip >= notifications_count:
-            return []
-
-        notifications = [self.convert_notification(note) for note in notifications_data]
-
-        return notifications[skip : min(skip + limit, notifications_count)]
+        if limit <= 0:
+            raise InvalidParameters()
+
+        query: dict = {"user_id": user_id}
+        if after_ts is not None:
+            query["$or"] = [
+                {"timestamp": {"$lt": after_ts}},
+                {"timestamp": after_ts, "_id": {"$lt": after_id}},
+            ]
+
+        notifications_data = (
+            await self._notifications.find(query, NOTIFICATION_PROJECTION)
+            .sort([("timestamp", -1), ("_id", -1)])
+            .limit(limit)
+            .to_list(limit)
+        )
+        return [
+            to_notification(cast(NotificationDocument, note))
+            for note in notifications_data
+        ]
 
     async def save_notification(self, notification: Notification):
-        notifications_data = await self.get_records(notification.user_id)
-        notifications = [self.convert_notification(note) for note in notifications_data]
-
-        if notifications:
-            for note_from_db in notifications:
-                if note_from_db.id == notification.id:
-                    await self._users.update_one(
-                        {"id": notification.user_id},
-                        {
-                            "$set": {
-                                "notifications": {
-                                    "$each": [notification.model_dump()],
-                                    "$sort": {"timestamp": -1},
-                                    "$slice": self._notifications_limit,
-                                }
-                            }
-                        },
-                    )
-
-        else:
-            await self._users.insert_one(
-                {
-                    "id": notification.user_id,
-                    "notifications": {
-                        "$each": [notification.model_dump()],
-                        "$sort": {"timestamp": -1},
-                        "$slice": self._notifications_limit,
-                    },
-                }
-            )
+        await self._sink.save(notification)
 
-    async def get_records(self, user_id: str) -> list:
-        """Retrieve records for a specific user ID."""
-
-        user_data = self._users.find({"id": user_id})
-        return [notification_data async for notification_data in user_data]
-
-    def convert_notification(self, notification: dict) -> Notification:
-        """Convert from the database dict object to Notification() model."""
-
-        notification_id = notification["notifications"]["$each"][0]["id"]
-        timestamp = notification["notifications"]["$each"][0]["timestamp"]
-        is_new = notification["notifications"]["$each"][0]["is_new"]
-        user_id = notification["notifications"]["$each"][0]["user_id"]
-        key = notification["notifications"]["$each"][0]["key"]
-        target_id = notification["notifications"]["$each"][0]["target_id"]
-        data = notification["notifications"]["$each"][0]["data"]
-        return Notification(
-            id=notification_id,
-            timestamp=timestamp,
-            is_new=is_new,
-            user_id=user_id,
-            key=key,
-            target_id=target_id,
-            data=data,
+    async def mark_read(self, user_id: str, notification_id: ObjectId) -> bool:
+        result = await self._notifications.update_one(
+            {"_id": notification_id, "user_id": user_id, "is_new": True},
+            {"$set": {"is_new": False}},
         )
+        if result.matched_count > 0:
+            return True
+
+        if not await self._notifications.count_documents(
+            {"_id": notification_id, "user_id": user_id}, limit=1
+        ):
+            raise NotificationNotFound()
+        return False
 
 
 class DatabaseException(Exception):
@@ -15,4 +15,18 @@ smtp = Smtp(
     email=os.environ["SMTP_EMAIL"],
     name=os.environ["SMTP_NAME"],
 )
-app = uvicorn.run(make_app(db, smtp), host="0.0.0.0", port=8000)
+app = make_app(db, smtp)
+app.add_event_handler("startup", db.connect)
+app.add_event_handler("shutdown", smtp.close)
+app.add_event_handler("shutdown", db.close)
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "notification_service.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", "2")),
+        access_log=False,
+    )
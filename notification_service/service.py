@@ -1,12 +1,14 @@
-import json
-from datetime import datetime
-from typing import Any, Generic, TypeAlias, TypeVar, assert_never
+import asyncio
+import logging
+import time
+from typing import Annotated, Any, Awaitable, Callable, Generic, TypeAlias, TypeVar
 
 from bson import ObjectId
 from fastapi import FastAPI
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, field_validator
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, StringConstraints, model_validator
+from pydantic_core import PydanticCustomError
 
 from notification_service.db import (
     Database,
@@ -18,49 +20,73 @@ from notification_service.db import (
 )
 from notification_service.smtp import SmtpRequest, SmtpService
 
+logger = logging.getLogger(__name__)
+
+SMTP_RETRIES = 3
+SMTP_RETRY_DELAY = 0.5
+SMTP_BATCH_SIZE = 50
+SMTP_BATCH_WINDOW = 0.005
+SMTP_DRAIN_TIMEOUT = 5
+SMTP_QUEUE_SIZE = 10_000
+
+
+ObjectIdStr: TypeAlias = Annotated[str, StringConstraints(min_length=24, max_length=24)]
+
+
+def parse_object_id(value: str) -> ObjectId:
+    """Convert a hex string from the request to ObjectId.
+
+    Raises:
+        InvalidParameters: the string is not a valid ObjectId.
+    """
+
+    if not ObjectId.is_valid(value):
+        raise InvalidParameters()
+    return ObjectId(value)
+
 
 class NotificationRequestPayload(BaseModel):
     """A view of the notification which the user sends through the body of the request.
 
     Attributes:
         user_id: The ID of the user to whom the notification is sent.
-            The number of characters must not exceed 24.
+            Must be 24 characters long.
         key: Key type, on which the further logic of service actions with this notification depends.
             'registration' - only send an email to a user;
             'new_message' or 'new_post' - only create a record in the database;
             'new_login' - create both an email to a user and a record in the database.
         target_id: The identifier of the target associated with the notification, if any.
-            The number of characters must not exceed 24.
+            Must be 24 characters long.
         target_email: mail to which the message is sent.
+            Required for 'registration' and 'new_login'.
         data: Additional data associated with the notification, if any.
     """
 
-    user_id: str
+    user_id: ObjectIdStr
     key: NotificationKey
-    target_id: str | None = None
+    target_id: ObjectIdStr | None = None
     target_email: str | None = None
     data: dict[str, Any] | None = None
 
-    @field_validator("user_id")
-    def check_user_id_length(cls, user_id: str):
-        assert (
-            len(user_id) == 24
-        ), "user_id is not a valid ObjectId. Must be 24 characters long."
-        return user_id
-
-    @field_validator("target_id")
-    def check_target_id_length(cls, target_id: str):
-        assert (
-            len(target_id) == 24
-        ), "target_id is not a valid ObjectId. Must be 24 characters long."
-        return target_id
+    @model_validator(mode="after")
+    def check_target_email(self) -> "NotificationRequestPayload":
+        if self.key in ("registration", "new_login") and self.target_email is None:
+            raise PydanticCustomError(
+                "missing_target_email",
+                "target_email is required for '{key}' notifications",
+                {"key": self.key},
+            )
+        return self
 
     def to_notification(self) -> Notification:
-        """Convert a view of notification from a request to the Notification() model."""
+        """Convert a view of notification from a request to the Notification() model.
 
-        return Notification(
-            id=str(ObjectId()),
-            timestamp=int(datetime.utcnow().timestamp()),
+        The payload is already validated, so the validation of the model is skipped.
+        """
+
+        return Notification.model_construct(
+            id=ObjectId(),
+            timestamp=int(time.time()),
             is_new=True,
             user_id=self.user_id,
             key=self.key,
@@ -69,10 +95,44 @@ class NotificationRequestPayload(BaseModel):
         )
 
 
+class Cursor(BaseModel):
+    """A position in the list of user's notifications to continue the listing from.
+
+    Attributes:
+        after_ts: The timestamp of the last returned notification.
+        after_id: The ID of the last returned notification.
+    """
+
+    after_ts: int
+    after_id: str
+
+
+class NotificationPage(BaseModel):
+    """A page of user's notifications.
+
+    Attributes:
+        notifications: notifications ordered from the newest to the oldest one.
+        next_cursor: a cursor to request the next page with,
+            or None if there are no more notifications.
+    """
+
+    notifications: list[Notification]
+    next_cursor: Cursor | None = None
+
+
+class BaseResponse(BaseModel):
+    """A base view of the response from the service."""
+
+    def to_http(self, status_code: int) -> ORJSONResponse:
+        """Convert into an ORJSONResponse instance with the specified status code."""
+
+        return ORJSONResponse(self.model_dump(mode="json"), status_code=status_code)
+
+
 T = TypeVar("T")
 
 
-class SuccessResponse(BaseModel, Generic[T]):
+class SuccessResponse(BaseResponse, Generic[T]):
     """A view of successful response from the service.
 
     Attributes:
@@ -85,7 +145,7 @@ class SuccessResponse(BaseModel, Generic[T]):
     data: T | None = None
 
 
-class FailureResponse(BaseModel):
+class FailureResponse(BaseResponse):
     """A view of an error response from the service.
 
     Attributes:
@@ -96,54 +156,120 @@ class FailureResponse(BaseModel):
     success: bool = False
     error: Any
 
-    def to_http(self, status_code: int) -> JSONResponse:
-        """Convert into a JSONResponse instance with the specified status code."""
-
-        return JSONResponse(self.model_dump(), status_code=status_code)
-
 
 ServiceResponse: TypeAlias = SuccessResponse | FailureResponse
 
 
 def make_app(db: Database, smtp: SmtpService) -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(default_response_class=ORJSONResponse)
+    app.state.smtp_queue = smtp_queue = asyncio.Queue[SmtpRequest](SMTP_QUEUE_SIZE)
+
+    async def send_emails(requests: list[SmtpRequest]):
+        """Send a batch of emails, retrying the failed ones with an exponential backoff."""
+
+        for attempt in range(SMTP_RETRIES):
+            if attempt > 0:
+                await asyncio.sleep(SMTP_RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                requests = await smtp.send_emails(requests)
+            except Exception:
+                logger.exception("Failed to send %d emails", len(requests))
+            if not requests:
+                return
+
+        for request in requests:
+            logger.error(
+                "Dropping an email to %s after %d attempts", request.to, SMTP_RETRIES
+            )
+
+    async def smtp_worker():
+        """Send the emails queued by the handlers in batches.
+
+        After the first email of a batch is taken, the worker waits for `SMTP_BATCH_WINDOW`
+        seconds and takes up to `SMTP_BATCH_SIZE` emails queued in the meantime.
+        """
 
-    @app.post("/create", status_code=201)
+        while True:
+            batch = [await smtp_queue.get()]
+            await asyncio.sleep(SMTP_BATCH_WINDOW)
+            while len(batch) < SMTP_BATCH_SIZE and not smtp_queue.empty():
+                batch.append(smtp_queue.get_nowait())
+            try:
+                await send_emails(batch)
+            finally:
+                for _ in batch:
+                    smtp_queue.task_done()
+
+    async def start_smtp_worker():
+        app.state.smtp_worker = asyncio.create_task(smtp_worker())
+
+    async def stop_smtp_worker():
+        try:
+            await asyncio.wait_for(smtp_queue.join(), SMTP_DRAIN_TIMEOUT)
+        except TimeoutError:
+            logger.error(
+                "Dropping %d queued emails: not sent in %s seconds on shutdown",
+                smtp_queue.qsize(),
+                SMTP_DRAIN_TIMEOUT,
+            )
+        app.state.smtp_worker.cancel()
+
+    app.add_event_handler("startup", start_smtp_worker)
+    app.add_event_handler("shutdown", stop_smtp_worker)
+
+    async def send_notification(payload: NotificationRequestPayload):
+        # The email is a side effect of the request, so when the mail service falls
+        # behind it is dropped rather than the request failed.
+        try:
+            smtp_queue.put_nowait(SmtpRequest(payload.target_email, payload.key))
+        except asyncio.QueueFull:
+            logger.error(
+                "Dropping an email to %s: the queue is full", payload.target_email
+            )
+
+    async def save_notification(payload: NotificationRequestPayload):
+        await db.save_notification(payload.to_notification())
+
+    async def save_and_send_notification(payload: NotificationRequestPayload):
+        # The email is queued first, so it is being sent while the notification is saved.
+        await send_notification(payload)
+        await save_notification(payload)
+
+    notification_handlers: dict[
+        NotificationKey, Callable[[NotificationRequestPayload], Awaitable[None]]
+    ] = {
+        "registration": send_notification,
+        "new_message": save_notification,
+        "new_post": save_notification,
+        "new_login": save_and_send_notification,
+    }
+
+    @app.post("/create", status_code=201, response_model=ServiceResponse)
     async def create_notification(
         payload: NotificationRequestPayload,
-    ) -> ServiceResponse:
+    ) -> ORJSONResponse:
         """Create a notification. Based on the value of the `key`, the following actions are performed:
-            NotificationKey.REGISTRATION - only send this notification to a user through mail service.
-            NotificationKey.NEW_MESSAGE - only create a notification in the database.
-            NotificationKey.NEW_POST - only create a notification in the database.
-            NotificationKey.NEW_LOGIN - create both an email to a user and a record in the database.
+            'registration' - only send this notification to a user through mail service.
+            'new_message' - only create a notification in the database.
+            'new_post' - only create a notification in the database.
+            'new_login' - create both an email to a user and a record in the database.
 
         Args:
             payload: A view of the notification
                 which the user sends through the body of the request.
 
+        Emails are sent in the background, so the response does not wait for the mail service.
+
         Returns:
             ServiceResponse: successful response to a user with code status 201.
                 If response is not successful - return error code.
         """
 
-        match payload.key:
-            case NotificationKey.REGISTRATION:
-                await smtp.send_email(SmtpRequest(payload.target_email, payload.key))
-            case NotificationKey.NEW_MESSAGE:
-                await db.save_notification(payload.to_notification())
-            case NotificationKey.NEW_POST:
-                await db.save_notification(payload.to_notification())
-            case NotificationKey.NEW_LOGIN:
-                await db.save_notification(payload.to_notification())
-                await smtp.send_email(SmtpRequest(payload.target_email, payload.key))
-            case _ as unreachable:
-                assert_never(unreachable)
-
-        return SuccessResponse()
-
-    @app.post("/read", status_code=200)
-    async def read_notification(user_id: str, notification_id: str) -> ServiceResponse:
+        await notification_handlers[payload.key](payload)
+        return SuccessResponse().to_http(201)
+
+    @app.post("/read", status_code=200, response_model=ServiceResponse)
+    async def read_notification(user_id: str, notification_id: str) -> ORJSONResponse:
         """Read a notification knowing its user_id and notification_id,
         change its status to `is_new = False` and update it in the database.
 
@@ -153,38 +279,64 @@ def make_app(db: Database, smtp: SmtpService) -> FastAPI:
 
         Returns:
             ServiceResponse: if response is successful, return code 200.
-                If it is not - code 404 (the user or the notification is not found).
+                If it is not - code 404 (the user or the notification is not found)
+                    or code 400 (`notification_id` is not a valid ObjectId).
         """
 
-        notification = await db.get_notification(user_id, notification_id)
-        if notification.is_new:
-            notification.is_new = False
-            await db.save_notification(notification)
-        return SuccessResponse()
+        await db.mark_read(user_id, parse_object_id(notification_id))
+        return SuccessResponse().to_http(200)
 
-    @app.get("/list", status_code=200)
+    @app.get("/list", status_code=200, response_model=ServiceResponse)
     async def get_notification_list(
-        user_id: str, skip: int, limit: int
-    ) -> ServiceResponse:
+        user_id: str,
+        limit: int,
+        after_ts: int | None = None,
+        after_id: str | None = None,
+    ) -> ORJSONResponse:
         """Get a list of notifications by knowing the ID of the user to whom the notifications belong.
 
+        Notifications are returned from the newest to the oldest one. To get the next page,
+        pass `after_ts` and `after_id` from the `next_cursor` of the previous page.
+
         Args:
             user_id: ID of the user to whom the notification belongs.
-            skip: the number of notifications that can be skipped.
             limit: the maximum number of notifications that should be returned.
+            after_ts: the timestamp of the last notification of the previous page.
+            after_id: the ID of the last notification of the previous page.
 
         Returns:
-            ServiceResponse: If the response is successful, code 200 is returned with a list of desired notifications.
-                If the response is unsuccessful: return code 400 when parameteres like `skip` or `limit` is invalid.
+            ServiceResponse: If the response is successful, code 200 is returned with a page of desired notifications.
+                If the response is unsuccessful: return code 400 when parameteres like `limit` or the cursor are invalid.
                     code 404 - the user is not found.
         """
 
-        list_notifications = await db.get_notifications(user_id, skip, limit)
-        return SuccessResponse(data=list_notifications)
+        if (after_ts is None) != (after_id is None):
+            raise InvalidParameters()
+
+        list_notifications = await db.get_notifications(
+            user_id,
+            limit,
+            after_ts,
+            parse_object_id(after_id) if after_id is not None else None,
+        )
+        next_cursor = None
+        if len(list_notifications) == limit:
+            last = list_notifications[-1]
+            next_cursor = Cursor(after_ts=last.timestamp, after_id=str(last.id))
+        return SuccessResponse(
+            data=NotificationPage(
+                notifications=list_notifications, next_cursor=next_cursor
+            )
+        ).to_http(200)
 
     @app.exception_handler(RequestValidationError)
     async def validation_exception_handler(request, exc):
-        return FailureResponse(error=str(exc)).to_http(400)
+        # The input is not echoed back: it is not always serializable to JSON.
+        errors = [
+            {name: value for name, value in error.items() if name != "input"}
+            for error in exc.errors()
+        ]
+        return FailureResponse(error=errors).to_http(400)
 
     @app.exception_handler(Exception)
     async def unknown_error_handler(request, exc):
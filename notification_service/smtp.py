@@ -1,11 +1,15 @@
-from dataclasses import dataclass
+import asyncio
+import logging
+from dataclasses import dataclass, field
 from email.message import EmailMessage
 from typing import Protocol
 
 import aiosmtplib
 
+logger = logging.getLogger(__name__)
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class SmtpRequest:
     """The model of the smtp request to the service.
 
@@ -21,13 +25,25 @@ class SmtpRequest:
 class SmtpService(Protocol):
     """Interface of mail service."""
 
-    async def send_email(self, request: SmtpRequest) -> None:
-        """Send email to user via mail service."""
+    __slots__ = ()
+
+    async def send_emails(self, requests: list[SmtpRequest]) -> list[SmtpRequest]:
+        """Send several emails to users via mail service in one session.
+
+        An email which fails to be sent does not stop the others.
 
+        Returns:
+            The requests whose emails were not sent.
+        """
 
-@dataclass(frozen=True)
+
+@dataclass(slots=True)
 class Smtp(SmtpService):
-    """Smtp mail implementation."""
+    """Smtp mail implementation.
+
+    The connection to the smtp server is opened on the first email and reused by
+    the following ones. It is reopened if the server has closed it.
+    """
 
     host: str
     port: int
@@ -35,14 +51,73 @@ class Smtp(SmtpService):
     password: str
     email: str
     name: str
+    _client: aiosmtplib.SMTP | None = field(default=None, init=False, repr=False)
+    _lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False, repr=False)
+    _from: str = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._from = f"{self.name} <{self.email}>"
+
+    async def send_emails(self, requests: list[SmtpRequest]) -> list[SmtpRequest]:
+        """Send several emails via smtp service over the same connection.
+
+        If the server cannot be connected to, the rest of the emails are not tried.
+        """
 
-    async def send_email(self, request: SmtpRequest) -> None:
-        """Send email via smtp service."""
+        failed = []
+        async with self._lock:
+            for index, request in enumerate(requests):
+                try:
+                    await self._send_message(self._make_message(request))
+                except aiosmtplib.SMTPConnectError:
+                    logger.exception("Failed to connect to %s:%s", self.host, self.port)
+                    failed.extend(requests[index:])
+                    break
+                except Exception:
+                    logger.exception("Failed to send an email to %s", request.to)
+                    failed.append(request)
+                    self._drop_client()
+        return failed
+
+    async def close(self) -> None:
+        """Close the connection to the smtp server, if any."""
+
+        async with self._lock:
+            if self._client is not None and self._client.is_connected:
+                await self._client.quit()
+            self._client = None
+
+    def _make_message(self, request: SmtpRequest) -> EmailMessage:
+        """Build an email message from the smtp request."""
 
         message = EmailMessage()
         message.set_content(request.message)
-        message["From"] = f"{self.name} <{self.email}>"
+        message["From"] = self._from
         message["To"] = request.to
+        return message
+
+    async def _send_message(self, message: EmailMessage) -> None:
+        """Send the message, reconnecting once if the server has closed the connection."""
+
+        try:
+            client = await self._connect()
+            await client.send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:
+            self._client = None
+            client = await self._connect()
+            await client.send_message(message)
+
+    def _drop_client(self) -> None:
+        """Close the connection after a failure, so the next email starts on a new one."""
+
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        """Return the cached connection to the smtp server, opening a new one if needed."""
 
-        async with aiosmtplib.SMTP(self.host, self.port) as server:
-            await server.send_message(message)
+        if self._client is None or not self._client.is_connected:
+            self._client = aiosmtplib.SMTP(hostname=self.host, port=self.port)
+            await self._client.connect()
+        return self._client
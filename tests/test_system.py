@@ -1,8 +1,9 @@
-import json
 import time
 
+import orjson
 import requests
 
+
 def test_creation():
     time.sleep(1)
     new_login_payload = {
@@ -17,13 +18,14 @@ def test_creation():
 
     list_endpoint_response = requests.get(
         "http://127.0.0.1:8000/list",
-        params={"user_id": "x" * 24, "skip": 0, "limit": 3},
+        params={"user_id": "x" * 24, "limit": 3},
     )
     assert list_endpoint_response.status_code == 200
-    # assert len(json.loads(list_endpoint_response.text)['data']) == 1
-    assert len(json.loads(list_endpoint_response.text)["data"]) == 1
+    data = orjson.loads(list_endpoint_response.content)["data"]
+    notifications = data["notifications"]
+    assert len(notifications) == 1
 
-    notification_id = json.loads(list_endpoint_response.text)["data"][0]["id"]
+    notification_id = notifications[0]["id"]
 
     read_endpoint_response = requests.post(
         "http://localhost:8000/read",
@@ -1,60 +1,85 @@
-import json
+import asyncio
+import bisect
 import time
+from collections import defaultdict
 from dataclasses import dataclass, field
 
+import aiosmtplib
+import aiosmtplib.email
+import orjson
 import pytest
+from bson import ObjectId
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
+from pymongo.errors import BulkWriteError
 
+from notification_service import service
 from notification_service.db import (
     Database,
     InvalidParameters,
     Notification,
     NotificationNotFound,
+    NotificationSink,
 )
 from notification_service.service import make_app
-from notification_service.smtp import SmtpRequest, SmtpService
+from notification_service.smtp import Smtp, SmtpRequest, SmtpService
 
 
-@dataclass(frozen=True)
+def sort_key(notification: Notification) -> tuple[int, ObjectId]:
+    return notification.timestamp, notification.id
+
+
+@dataclass(frozen=True, slots=True)
 class FakeDb(Database):
-    documents: list[Notification] = field(default_factory=list)
+    # The notifications of each user, from the oldest to the newest one.
+    by_user: dict[str, list[Notification]] = field(
+        default_factory=lambda: defaultdict(list)
+    )
+
+    @property
+    def documents(self) -> list[Notification]:
+        return [n for notifications in self.by_user.values() for n in notifications]
 
     async def get_notification(
-        self, user_id: str, notification_id: str
+        self, user_id: str, notification_id: ObjectId
     ) -> Notification:
-        user_records = self._get_user(user_id)
-        for record in user_records:
-            if record.id == notification_id:
-                return record
-
+        for notification in self.by_user.get(user_id, []):
+            if notification.id == notification_id:
+                return notification
         raise NotificationNotFound()
 
     async def get_notifications(
-        self, user_id: str, skip: int, limit: int
+        self,
+        user_id: str,
+        limit: int,
+        after_ts: int | None = None,
+        after_id: ObjectId | None = None,
     ) -> list[Notification]:
-        user = self._get_user(user_id)
-        if 0 <= skip < len(user) and limit > 0:
-            return user[skip : skip + limit]
-        raise InvalidParameters()
+        if limit <= 0:
+            raise InvalidParameters()
+        notifications = self.by_user.get(user_id, [])
+        end = len(notifications)
+        if after_ts is not None:
+            end = bisect.bisect_left(notifications, (after_ts, after_id), key=sort_key)
+        return notifications[max(end - limit, 0) : end][::-1]
 
     async def save_notification(self, notification: Notification):
-        self.documents.append(notification)
+        bisect.insort(self.by_user[notification.user_id], notification, key=sort_key)
 
-    def _get_user(self, user_id: str) -> list[Notification]:
-        user_records = []
-        for notification in self.documents:
-            if notification.user_id == user_id:
-                user_records.append(notification)
-        return user_records
+    async def mark_read(self, user_id: str, notification_id: ObjectId) -> bool:
+        notification = await self.get_notification(user_id, notification_id)
+        was_new = notification.is_new
+        notification.is_new = False
+        return was_new
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class FakeSmtp(SmtpService):
     requests: list[SmtpRequest] = field(default_factory=list)
 
-    async def send_email(self, request: SmtpRequest):
-        self.requests.append(request)
+    async def send_emails(self, requests: list[SmtpRequest]) -> list[SmtpRequest]:
+        self.requests.extend(requests)
+        return []
 
 
 class TestApp:
@@ -63,11 +88,17 @@ class TestApp:
     app: FastAPI
     client: TestClient
 
-    def setup_method(self):
+    @pytest.fixture(autouse=True)
+    def setup(self):
         self.db = FakeDb()
         self.smtp = FakeSmtp()
         self.app = make_app(self.db, self.smtp)
-        self.client = TestClient(self.app)
+        with TestClient(self.app) as client:
+            self.client = client
+            yield
+
+    def _wait_for_emails(self):
+        self.client.portal.call(self.app.state.smtp_queue.join)
 
     def test_create_notification_registration(self):
         payload = {
@@ -77,18 +108,22 @@ class TestApp:
         }
         response = self.client.post("/create", json=payload)
         assert response.status_code == 201
+        self._wait_for_emails()
         assert len(self.smtp.requests) == 1
         assert self.smtp.requests[0] == SmtpRequest(
             "reciever@mail.ru",
             payload["key"],
         )
-        assert json.loads(response.text)["success"]
+        assert orjson.loads(response.content)["success"]
 
     @pytest.mark.parametrize(
         "user_id, key",
         [
             ("x" * 24, "invalid"),
             ("x" * 23, "invalid"),
+            ("x" * 23, "new_message"),
+            ("x" * 24, "registration"),
+            ("x" * 24, "new_login"),
         ],
     )
     def test_create_notification_invalid_payload(self, user_id, key):
@@ -98,7 +133,25 @@ class TestApp:
         }
         response = self.client.post("/create", json=payload)
         assert response.status_code == 400
-        assert json.loads(response.text)["success"] == False
+        body = orjson.loads(response.content)
+        assert body["success"] == False
+        assert all(error["loc"][0] == "body" for error in body["error"])
+
+    @pytest.mark.parametrize(
+        "content, content_type",
+        [
+            (b"\xff\xfe\x00", "text/plain"),
+            (b'{"user_id": "\\ud800", "key": "new_post"}', "application/json"),
+        ],
+    )
+    def test_create_notification_undecodable_payload(self, content, content_type):
+        response = self.client.post(
+            "/create", content=content, headers={"Content-Type": content_type}
+        )
+        assert response.status_code == 400
+        body = orjson.loads(response.content)
+        assert body["success"] == False
+        assert all("input" not in error for error in body["error"])
 
     @pytest.mark.parametrize(
         "user_id, key",
@@ -111,14 +164,14 @@ class TestApp:
         payload = {
             "user_id": user_id,
             "key": key,
+            "target_email": "reciever@mail.ru",
         }
         response = self.client.post("/create", json=payload)
         assert response.status_code == 201
-        assert json.loads(response.text)["success"] == True
+        assert orjson.loads(response.content)["success"] == True
+        self._wait_for_emails()
         if key == "new_message":
-            assert (
-                len(self.db._get_user("x" * 24)) == 1 and len(self.smtp.requests) == 0
-            )
+            assert len(self.db.by_user["x" * 24]) == 1 and len(self.smtp.requests) == 0
         elif key == "new_login":
             assert len(self.smtp.requests) == 1 and len(self.db.documents) == 1
 
@@ -133,12 +186,20 @@ class TestApp:
         first_record = self.db.documents[0]
         assert first_record.is_new == True
         response = self.client.post(
-            "/read", params={"user_id": "x" * 24, "notification_id": first_record.id}
+            "/read",
+            params={"user_id": "x" * 24, "notification_id": str(first_record.id)},
+        )
+        assert response.status_code == 200
+        assert len(self.db.documents) == 1
+        assert first_record.is_new == False
+        assert orjson.loads(response.content)["success"] == True
+
+        response = self.client.post(
+            "/read",
+            params={"user_id": "x" * 24, "notification_id": str(first_record.id)},
         )
         assert response.status_code == 200
-        second_record = self.db.documents[1]
-        assert second_record.is_new == False
-        assert json.loads(response.text)["success"] == True
+        assert first_record.is_new == False
 
     def test_read_not_found(self):
         payload = {
@@ -149,10 +210,20 @@ class TestApp:
         self.client.post("/create", json=payload)
         response = self.client.post(
             "/read",
-            params={"user_id": "y" * 24, "notification_id": self.db.documents[0].id},
+            params={
+                "user_id": "y" * 24,
+                "notification_id": str(self.db.documents[0].id),
+            },
         )
         assert response.status_code == 404
-        assert json.loads(response.text)["error"] == "Notification not found"
+        assert orjson.loads(response.content)["error"] == "Notification not found"
+
+    def test_read_invalid_notification_id(self):
+        response = self.client.post(
+            "/read", params={"user_id": "x" * 24, "notification_id": "x" * 24}
+        )
+        assert response.status_code == 400
+        assert orjson.loads(response.content)["error"] == "Invalid parameters"
 
     def test_get_list_notifications(self):
         payload = {
@@ -163,14 +234,33 @@ class TestApp:
         for _ in range(3):
             self.client.post("/create", json=payload)
             time.sleep(0.05)
+        response = self.client.get("/list", params={"user_id": "x" * 24, "limit": 2})
+        assert response.status_code == 200
+        first_page = orjson.loads(response.content)["data"]
+        assert len(first_page["notifications"]) == 2
+        assert first_page["next_cursor"] is not None
+
         response = self.client.get(
-            "/list", params={"user_id": "x" * 24, "skip": 1, "limit": 1}
+            "/list",
+            params={"user_id": "x" * 24, "limit": 2, **first_page["next_cursor"]},
         )
         assert response.status_code == 200
-        data = json.loads(response.text)["data"]
-        assert len(data) == 1
+        second_page = orjson.loads(response.content)["data"]
+        assert len(second_page["notifications"]) == 1
+        assert second_page["next_cursor"] is None
+        ids = {
+            n["id"] for n in first_page["notifications"] + second_page["notifications"]
+        }
+        assert ids == {str(n.id) for n in self.db.documents}
 
-    def test_get_list_notifications_error(self):
+    @pytest.mark.parametrize(
+        "params",
+        [
+            {"limit": 0},
+            {"limit": 1, "after_ts": 0},
+        ],
+    )
+    def test_get_list_notifications_error(self, params):
         payload = {
             "user_id": "x" * 24,
             "key": "new_message",
@@ -179,8 +269,254 @@ class TestApp:
         for _ in range(3):
             self.client.post("/create", json=payload)
             time.sleep(0.05)
-        response = self.client.get(
-            "/list", params={"user_id": "x" * 24, "skip": 3, "limit": 1}
-        )
+        response = self.client.get("/list", params={"user_id": "x" * 24, **params})
         assert response.status_code == 400
-        assert json.loads(response.text)["error"] == "Invalid parameters"
+        assert orjson.loads(response.content)["error"] == "Invalid parameters"
+
+
+class HangingSmtp(SmtpService):
+    async def send_emails(self, requests: list[SmtpRequest]) -> list[SmtpRequest]:
+        await asyncio.Event().wait()
+        return requests
+
+
+def test_shutdown_does_not_wait_for_stuck_emails(monkeypatch):
+    monkeypatch.setattr(service, "SMTP_DRAIN_TIMEOUT", 0.1)
+    payload = {
+        "user_id": "x" * 24,
+        "key": "registration",
+        "target_email": "reciever@mail.ru",
+    }
+    start = time.monotonic()
+    with TestClient(make_app(FakeDb(), HangingSmtp())) as client:
+        assert client.post("/create", json=payload).status_code == 201
+    assert time.monotonic() - start < 2
+
+
+def test_create_drops_emails_when_queue_is_full(monkeypatch):
+    monkeypatch.setattr(service, "SMTP_QUEUE_SIZE", 1)
+    monkeypatch.setattr(service, "SMTP_DRAIN_TIMEOUT", 0.1)
+    payload = {
+        "user_id": "x" * 24,
+        "key": "registration",
+        "target_email": "reciever@mail.ru",
+    }
+    app = make_app(FakeDb(), HangingSmtp())
+    with TestClient(app) as client:
+        for _ in range(3):
+            assert client.post("/create", json=payload).status_code == 201
+        assert app.state.smtp_queue.qsize() == 1
+
+
+@dataclass(frozen=True, slots=True)
+class RefusingSmtp(SmtpService):
+    """Sends every email except the ones to `refused`, recording each attempt."""
+
+    refused: str
+    attempts: list[SmtpRequest] = field(default_factory=list)
+    sent: list[SmtpRequest] = field(default_factory=list)
+
+    async def send_emails(self, requests: list[SmtpRequest]) -> list[SmtpRequest]:
+        self.attempts.extend(requests)
+        self.sent.extend(r for r in requests if r.to != self.refused)
+        return [r for r in requests if r.to == self.refused]
+
+
+def test_worker_retries_only_failed_emails(monkeypatch):
+    monkeypatch.setattr(service, "SMTP_RETRY_DELAY", 0)
+    monkeypatch.setattr(service, "SMTP_BATCH_WINDOW", 0.1)
+    smtp = RefusingSmtp(refused="bad@mail.ru")
+    app = make_app(FakeDb(), smtp)
+    with TestClient(app) as client:
+        for email in ("bad@mail.ru", "good@mail.ru"):
+            payload = {
+                "user_id": "x" * 24,
+                "key": "registration",
+                "target_email": email,
+            }
+            assert client.post("/create", json=payload).status_code == 201
+        client.portal.call(app.state.smtp_queue.join)
+
+    assert smtp.sent == [SmtpRequest("good@mail.ru", "registration")]
+    assert [r.to for r in smtp.attempts].count("bad@mail.ru") == service.SMTP_RETRIES
+    assert [r.to for r in smtp.attempts].count("good@mail.ru") == 1
+
+
+class FakeSmtpClient:
+    def __init__(self):
+        self.recipients: list[str] = []
+
+    async def send_message(self, message):
+        recipients = aiosmtplib.email.extract_recipients(message)
+        if "refused@mail.ru" in recipients:
+            raise aiosmtplib.SMTPRecipientsRefused([])
+        if "broken@mail.ru" in recipients:
+            raise OSError("Connection reset by peer")
+        self.recipients.extend(recipients)
+
+    def close(self):
+        pass
+
+
+def test_smtp_sends_rest_of_batch_after_failure(monkeypatch):
+    client = FakeSmtpClient()
+
+    async def connect(self):
+        return client
+
+    monkeypatch.setattr(Smtp, "_connect", connect)
+    smtp = Smtp("host", 25, "login", "password", "foo@mail.ru", "name")
+    requests = [
+        SmtpRequest("broken@mail.ru", "new_login"),
+        SmtpRequest("refused@mail.ru", "new_login"),
+        SmtpRequest("reciever@mail.ru", "registration"),
+    ]
+
+    failed = asyncio.run(smtp.send_emails(requests))
+
+    assert failed == requests[:2]
+    assert client.recipients == ["reciever@mail.ru"]
+
+
+class FakeCursor:
+    def __init__(self, documents: list[dict]):
+        self.documents = documents
+
+    def sort(self, keys: list[tuple[str, int]]) -> "FakeCursor":
+        for name, direction in reversed(keys):
+            self.documents.sort(key=lambda doc: doc[name], reverse=direction < 0)
+        return self
+
+    def skip(self, count: int) -> "FakeCursor":
+        self.documents = self.documents[count:]
+        return self
+
+    async def to_list(self, length: int | None) -> list[dict]:
+        return self.documents[:length]
+
+
+class FakeCollection:
+    """In-memory collection which supports the queries of `NotificationSink`."""
+
+    def __init__(self, failing_ids: set[ObjectId] = frozenset()):
+        self.documents: dict[ObjectId, dict] = {}
+        self.failing_ids = failing_ids
+        self.bulk_writes = 0
+
+    async def bulk_write(self, requests, ordered: bool):
+        self.bulk_writes += 1
+        errors = []
+        for index, request in enumerate(requests):
+            _id = request._filter["_id"]
+            if _id in self.failing_ids:
+                errors.append({"index": index, "code": 121, "errmsg": "invalid"})
+                continue
+            self.documents[_id] = {"_id": _id, **request._doc["$set"]}
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    def find(self, query: dict, projection: dict) -> FakeCursor:
+        return FakeCursor(
+            [
+                {"_id": doc["_id"], "timestamp": doc["timestamp"]}
+                for doc in self.documents.values()
+                if doc["user_id"] == query["user_id"]
+            ]
+        )
+
+    async def delete_many(self, query: dict):
+        for _id in query["_id"]["$in"]:
+            del self.documents[_id]
+
+
+def make_notification(user_id: str, timestamp: int) -> Notification:
+    return Notification(
+        id=ObjectId(),
+        timestamp=timestamp,
+        is_new=True,
+        user_id=user_id,
+        key="registration",
+    )
+
+
+def test_sink_writes_batch_and_fails_only_rejected_notifications():
+    good, bad = make_notification("1", 1), make_notification("2", 2)
+    collection = FakeCollection(failing_ids={bad.id})
+
+    async def run():
+        sink = NotificationSink(collection, notifications_limit=3)  # type: ignore[arg-type]
+        results = await asyncio.gather(
+            sink.save(good), sink.save(bad), return_exceptions=True
+        )
+        await sink.close()
+        return results
+
+    results = asyncio.run(run())
+
+    assert results[0] is None
+    assert isinstance(results[1], BulkWriteError)
+    assert collection.bulk_writes == 1
+    assert list(collection.documents) == [good.id]
+
+
+def test_sink_trims_notifications_over_limit():
+    notifications = [make_notification("1", timestamp) for timestamp in (2, 3, 1)]
+    other = make_notification("2", 0)
+    collection = FakeCollection()
+
+    async def run():
+        sink = NotificationSink(collection, notifications_limit=2)  # type: ignore[arg-type]
+        await asyncio.gather(*(sink.save(n) for n in [*notifications, other]))
+        await sink._trim_task
+        await sink.close()
+
+    asyncio.run(run())
+
+    assert set(collection.documents) == {
+        notifications[0].id,
+        notifications[1].id,
+        other.id,
+    }
+
+
+class HangingCursor(FakeCursor):
+    async def to_list(self, length: int | None) -> list[dict]:
+        await asyncio.Event().wait()
+        return []
+
+
+class HangingTrimCollection(FakeCollection):
+    def find(self, query: dict, projection: dict) -> FakeCursor:
+        return HangingCursor([])
+
+
+def test_sink_writes_while_trimming():
+    collection = HangingTrimCollection()
+
+    async def run():
+        sink = NotificationSink(collection, notifications_limit=3)  # type: ignore[arg-type]
+        await sink.save(make_notification("1", 1))
+        await asyncio.wait_for(sink.save(make_notification("2", 2)), timeout=1)
+        await sink.close()
+
+    asyncio.run(run())
+
+    assert collection.bulk_writes == 2
+
+
+def test_sink_restarts_stopped_writer():
+    collection = FakeCollection()
+
+    async def run():
+        sink = NotificationSink(collection, notifications_limit=3)  # type: ignore[arg-type]
+        await sink.save(make_notification("1", 1))
+        sink._task.cancel()
+        await asyncio.wait([sink._task])
+        await sink.save(make_notification("1", 2))
+        await sink.close()
+        return sink
+
+    sink = asyncio.run(run())
+
+    assert len(collection.documents) == 2
+    assert sink._task is None